@@ -4,23 +4,46 @@ renaming a branch, updating the default branch, adding collaborators and teams t
 and protecting a branch.
 """
 
-import requests
+import urllib3
+from urllib3.connection import HTTPConnection
+from urllib3.util import Retry
 import json
 import argparse
 import os
 import base64
+import dbm
+import hashlib
+import itertools
+import shelve
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# .gitignore committed to every new repo, the whole request payload is built once at import
+_GITIGNORE_CONTENT_B64 = base64.b64encode(
+    b".terraform\n.terraform.tfstate\n*.tfstate*\n*.zip*\n.idea\n.secret.auto.tfvars").decode("ascii")
+_GITIGNORE_PAYLOAD = {
+    "message": ".gitignore file added",
+    "content": _GITIGNORE_CONTENT_B64
+}
+
+# urllib3 already disables Nagle, also keep idle pooled connections alive between bootstrap steps
+_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+if hasattr(socket, "TCP_KEEPIDLE"):
+    _SOCKET_OPTIONS += [
+        (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30),
+        (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+    ]
+
+
+class GitHubRetry(Retry):
+    """
+    Retry policy that leaves 403/429 rate limits to Repo._request, so a spent token is rotated out instead of
+    being retried in place.
+    """
 
-# Parse command line arguments
-parser = argparse.ArgumentParser(description="GitHub Repo Creation Utility",
-                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument("-n", "--name", help="Repository Name")
-parser.add_argument("-o", "--organization", help="Organization Name")
-parser.add_argument("-d", "--description",
-                    help="Repository Description", default="")
-parser.add_argument("-b", "--defbranch", help="Default Branch", default="main")
-args = parser.parse_args()
-config = vars(args)
-print(f"Arguments Passed in: {config}")
+    RETRY_AFTER_STATUS_CODES = frozenset([503])
 
 
 class Repo:
@@ -32,9 +55,35 @@ class Repo:
     # Class attributes
     auth_headers = {
         "Accept": "application/vnd.github+json",
-        "Content-Type": "application/json",
-        "Authorization": "Bearer {}".format(os.getenv("GITHUB_TOKEN"))
+        "Content-Type": "application/json"
+    }
+    cache_name = ".gh_cache"
+    rate_limit_retries = 5
+    # Kept low so a burst of grants does not trip GitHub's secondary rate limit
+    grant_workers = 4
+
+    # Static parts of the request payloads, only the per-call fields are filled in
+    _REPO_TEMPLATE = {
+        "homepage": "https://github.com",
+        "private": True,
+        "has_issues": True,
+        "has_projects": True,
+        "has_wiki": True,
+        "auto_init": True
+    }
+    _PROTECTION_TEMPLATE = {
+        "required_status_checks": None,
+        "enforce_admins": True,
+        "allow_force_pushes": False,
+        "allow_deletions": False,
     }
+    _REVIEWS_TEMPLATE = {
+        "dismiss_stale_reviews": True,
+        "required_approving_review_count": 1,
+        "require_last_push_approval": True,
+    }
+    # Immutable default for unset team/user lists, json serialises it as []
+    _EMPTY_LIST = ()
 
     def __init__(self, org, repo_name):
         """
@@ -44,6 +93,137 @@ class Repo:
         self.org = org
         self.repo_name = "repo-{}".format(repo_name)
 
+        # One connection pool per repo so every call reuses the same TLS connection
+        retries = GitHubRetry(
+            total=6,
+            backoff_factor=1.0,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=frozenset(["GET", "PUT", "POST", "PATCH", "DELETE"]),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        self.http = urllib3.PoolManager(
+            num_pools=1, maxsize=10, retries=retries, socket_options=_SOCKET_OPTIONS)
+
+        # Rotate through every configured token so bulk runs are not capped by one token's quota
+        tokens = [os.getenv("GITHUB_TOKEN", "")] + os.getenv("GITHUB_TOKENS", "").split(",")
+        tokens = list(dict.fromkeys(token.strip() for token in tokens if token.strip())) or [None]
+        self._tokens = itertools.cycle(tokens)
+        self._token_count = len(tokens)
+        self._token_reset = {}
+        self._token_lock = threading.Lock()
+
+        # Digests of payloads already applied, so re-runs skip identical PUTs. One file per repo keeps
+        # concurrent bulk runs apart, and a file held by another run just means running without a cache.
+        try:
+            self._cache = shelve.open("{}-{}-{}".format(self.cache_name, self.org, self.repo_name))
+        except dbm.error:
+            print("Local cache in use by another run, continuing without it")
+            self._cache = shelve.Shelf({})
+        self._cache_lock = threading.Lock()
+
+    def close(self):
+        """
+        Close the pooled connections and flush the local payload cache.
+        """
+
+        self.http.clear()
+        self._cache.close()
+
+    def _park_token(self, authorization, response_headers):
+        """
+        Skip the token behind the given Authorization header until its rate limit resets.
+        """
+
+        token = authorization.split(" ", 1)[1]
+        with self._token_lock:
+            self._token_reset[token] = int(response_headers.get("X-RateLimit-Reset", time.time() + 60))
+
+    def _pick_headers(self):
+        """
+        Return the Authorization header for the next token that still has rate limit budget.
+        """
+
+        with self._token_lock:
+            for _ in range(self._token_count):
+                token = next(self._tokens)
+                if self._token_reset.get(token, 0) <= time.time():
+                    return {"Authorization": "Bearer {}".format(token)}
+            # Every token is exhausted, wait for the first one to reset
+            token = min(self._token_reset, key=self._token_reset.get)
+            wait = self._token_reset[token] - time.time()
+        if wait > 0:
+            print("Rate limit exhausted, waiting {:.0f}s".format(wait))
+            time.sleep(wait)
+        return {"Authorization": "Bearer {}".format(token)}
+
+    def _request(self, method, url, **kwargs):
+        """
+        Send a request with a rotated token, waiting out secondary rate limits and moving on to the next
+        token when one runs out of quota.
+        """
+
+        extra_headers = kwargs.pop("headers", {})
+        for _ in range(self._token_count + self.rate_limit_retries):
+            headers = self._pick_headers()
+            r = self.http.request(method, url, headers={**self.auth_headers, **extra_headers, **headers}, **kwargs)
+            if r.status not in (403, 429):
+                return r
+            if "Retry-After" in r.headers:
+                # Secondary rate limit, GitHub says exactly how long to back off
+                wait = int(r.headers["Retry-After"])
+            elif r.headers.get("X-RateLimit-Remaining") == "0":
+                self._park_token(headers["Authorization"], r.headers)
+                continue
+            elif b"secondary rate limit" in r.data.lower():
+                # Secondary rate limit without Retry-After, GitHub asks to wait at least a minute
+                wait = 60
+            else:
+                # A plain 403 is a permissions error, retrying will not help
+                return r
+            print("Secondary rate limit hit, retrying in {}s".format(wait))
+            time.sleep(wait)
+        return r
+
+    def _put_if_changed(self, url, payload):
+        """
+        PUT the payload to url unless the same payload was already applied, returns None when skipped.
+        """
+
+        digest = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+        with self._cache_lock:
+            if self._cache.get(url) == digest:
+                return None
+
+        r = self._request("PUT", url, json=payload)
+
+        if r.status in (200, 201):
+            with self._cache_lock:
+                self._cache[url] = digest
+                self._cache.sync()
+        return r
+
+    def _exists(self):
+        """
+        Check whether the repository already exists, using a conditional GET so repeat checks are free.
+        """
+
+        url = "https://api.github.com/repos/{}/{}".format(self.org, self.repo_name)
+        with self._cache_lock:
+            etag = self._cache.get("etag:" + url)
+
+        r = self._request("GET", url, headers={"If-None-Match": etag} if etag else {})
+
+        if r.status == 304:
+            return True
+        if r.status == 200:
+            if "ETag" in r.headers:
+                with self._cache_lock:
+                    self._cache["etag:" + url] = r.headers["ETag"]
+                    self._cache.sync()
+            return True
+        return False
+
     # Create Repo Method
     def create_repo(self, repo_description):
         """
@@ -51,28 +231,27 @@ class Repo:
         """
 
         repo_creation_config = {
+            **self._REPO_TEMPLATE,
             "name": self.repo_name,
-            "description": f"{repo_description}",
-            "homepage": "https://github.com",
-            "private": True,
-            "has_issues": True,
-            "has_projects": True,
-            "has_wiki": True,
-            "auto_init": True
+            "description": f"{repo_description}"
         }
 
-        r = requests.post(
+        r = self._request(
+            "POST",
             "https://api.github.com/user/repos",
-            headers=self.auth_headers,
-            data=json.dumps(repo_creation_config)
+            json=repo_creation_config
         )
 
-        res_dict = json.loads(r.text)
-
-        if r.status_code == 201:
-            print(f"Created: {res_dict['html_url']}")
+        if r.status == 201:
+            print(f"Created: https://github.com/{self.org or '<user>'}/{self.repo_name}")
+            # A freshly created repo has none of the cached state, forget it
+            prefix = "https://api.github.com/repos/{}/{}/".format(self.org, self.repo_name)
+            with self._cache_lock:
+                for key in [k for k in self._cache if k.startswith(prefix)]:
+                    del self._cache[key]
+                self._cache.sync()
         else:
-            print(f'Create repo error Message: {res_dict["message"]}')
+            print(f'Create repo error Message: {r.json()["message"]}')
 
         return repo_creation_config["name"]
 
@@ -81,101 +260,105 @@ class Repo:
         Rename a branch in the repository from old_name to new_name.
         """
 
-        r = requests.post(
+        r = self._request(
+            "POST",
             "https://api.github.com/repos/{}/{}/branches/{}/rename".format(
                 self.org, self.repo_name, old_name),
-            headers=self.auth_headers,
-            data=json.dumps({"new_name": new_name})
+            json={"new_name": new_name}
         )
 
-        res_dict = json.loads(r.text)
-
-        if r.status_code == 201:
+        if r.status == 201:
             print("Default branch is now: {}".format(new_name))
         else:
-            print('Error Message: {}'.format(res_dict["message"]))
+            print('Error Message: {}'.format(r.json()["message"]))
 
     def update_default_branch(self, default_branch):
         """
         Update the default branch of the repository to the given branch.
         """
 
-        r = requests.patch(
+        r = self._request(
+            "PATCH",
             "https://api.github.com/repos/{}/{}".format(
                 self.org, self.repo_name),
-            headers=self.auth_headers,
-            data=json.dumps({"default_branch": default_branch})
+            json={"default_branch": default_branch}
         )
 
-        res_dict = json.loads(r.text)
-
-        if r.status_code == 200:
+        if r.status == 200:
             print("Default branch is now: {}".format(default_branch))
         else:
-            print('Error Message: {}'.format(res_dict["message"]))
+            print('Error Message: {}'.format(r.json()["message"]))
 
     def add_repo_collaborator(self, username, permission):
         """
         Add a collaborator with the given username and permission to the repository.
         """
 
-        r = requests.put(
+        r = self._request(
+            "PUT",
             "https://api.github.com/repos/{}/{}/collaborators/{}".format(
                 self.org, self.repo_name, username),
-            headers=self.auth_headers,
-            data=json.dumps({"permission": permission})
+            json={"permission": permission}
         )
 
-        if r.status_code == 200:
+        if r.status == 200:
             print("{} added to repo with permission: {}".format(
                 username, permission))
-        elif r.status_code == 204:
+        elif r.status == 204:
             print("{} already has {} permissions".format(username, permission))
         else:
-            res_dict = json.loads(r.text)
-            print('Error Message: {}'.format(res_dict["message"]))
+            print('Error Message: {}'.format(r.json()["message"]))
 
     def add_repo_team(self, team_name, permission):
         """
         Add a team with the given name and permission to the repository.
         """
 
-        r = requests.put(
+        r = self._request(
+            "PUT",
             "https://api.github.com/orgs/{0}/teams/{1}/repos/{0}/{2}".format(
                 self.org, team_name, self.repo_name),
-            headers=self.auth_headers,
-            data=json.dumps({"permission": permission})
+            json={"permission": permission}
         )
 
-        if r.status_code == 204:
+        if r.status == 204:
             print("{} team added as {}".format(team_name, permission))
         else:
-            res_dict = json.loads(r.text)
-            print('Error Message: {}'.format(res_dict["message"]))
+            print('Error Message: {}'.format(r.json()["message"]))
+
+    def add_repo_collaborators(self, grants):
+        """
+        Add several collaborators at once, grants is a list of (username, permission) pairs.
+        """
+
+        with ThreadPoolExecutor(max_workers=self.grant_workers) as executor:
+            list(executor.map(lambda grant: self.add_repo_collaborator(*grant), grants))
+
+    def add_repo_teams(self, grants):
+        """
+        Add several teams at once, grants is a list of (team_name, permission) pairs.
+        """
+
+        with ThreadPoolExecutor(max_workers=self.grant_workers) as executor:
+            list(executor.map(lambda grant: self.add_repo_team(*grant), grants))
 
     def add_gitignore_to_repo(self):
         """
         Add a .gitignore file to the repository.
         """
 
-        content = ".terraform\n.terraform.tfstate\n*.tfstate*\n*.zip*\n.idea\n.secret.auto.tfvars"
-        encoded_content = base64.b64encode(content.encode()).decode()
-
-        r = requests.put(
+        r = self._put_if_changed(
             "https://api.github.com/repos/{}/{}/contents/.gitignore".format(
                 self.org, self.repo_name),
-            headers=self.auth_headers,
-            json={
-                "message": ".gitignore file added",
-                "content":  encoded_content
-            }
+            _GITIGNORE_PAYLOAD
         )
 
-        if r.status_code == 201:
+        if r is None:
+            print(".gitignore file unchanged, skipping")
+        elif r.status == 201:
             print("{} .gitignore file added {}")
         else:
-            res_dict = json.loads(r.text)
-            print('Error Message: {}'.format(res_dict["message"]))
+            print('Error Message: {}'.format(r.json()["message"]))
 
     def protect_branch(
             self,
@@ -190,59 +373,82 @@ class Repo:
         Protect a branch in the repository with the given settings.
         """
 
-        if pr_dismissal_teams is None:
-            pr_dismissal_teams = []
-        if pr_dismissal_users is None:
-            pr_dismissal_users = []
-        if pr_bypass_teams is None:
-            pr_bypass_teams = []
-        if pr_bypass_users is None:
-            pr_bypass_users = []
-        if restriction_bypass_teams is None:
-            restriction_bypass_teams = []
-        if restriction_bypass_users is None:
-            restriction_bypass_users = []
-
         branch_protection_config = {
-            "required_status_checks": None,
-            "enforce_admins": True,
+            **self._PROTECTION_TEMPLATE,
             "required_pull_request_reviews": {
+                **self._REVIEWS_TEMPLATE,
                 "dismissal_restrictions": {
-                    "teams": pr_dismissal_teams,
-                    "users": pr_dismissal_users
+                    "teams": pr_dismissal_teams or self._EMPTY_LIST,
+                    "users": pr_dismissal_users or self._EMPTY_LIST
                 },
-                "dismiss_stale_reviews": True,
-                "required_approving_review_count": 1,
-                "require_last_push_approval": True,
                 "bypass_pull_request_allowances": {
-                    "teams": pr_bypass_teams,
-                    "users": pr_bypass_users
+                    "teams": pr_bypass_teams or self._EMPTY_LIST,
+                    "users": pr_bypass_users or self._EMPTY_LIST
                 },
             },
             "restrictions": {
-                "teams": restriction_bypass_teams,
-                "users": restriction_bypass_users
+                "teams": restriction_bypass_teams or self._EMPTY_LIST,
+                "users": restriction_bypass_users or self._EMPTY_LIST
             },
-            "allow_force_pushes": False,
-            "allow_deletions": False,
         }
 
-        r = requests.put(
+        r = self._request(
+            "PUT",
             "https://api.github.com/repos/{}/{}/branches/{}/protection".format(
                 self.org, self.repo_name, branch_name),
-            headers=self.auth_headers,
-            data=json.dumps(branch_protection_config)
+            json=branch_protection_config
         )
 
-        if r.status_code == 200:
+        if r.status == 200:
             print("{} branch is now protected".format(branch_name))
         else:
-            res_dict = json.loads(r.text)
-            print('Error Message: {}'.format(res_dict["message"]))
+            print('Error Message: {}'.format(r.json()["message"]))
 
 
-if __name__ == '__main__':
-    if "GITHUB_TOKEN" not in os.environ:
+def load_grants(path):
+    """
+    Read a JSON file mapping names to permissions into a list of (name, permission) pairs.
+    """
+
+    if path is None:
+        return []
+    try:
+        with open(path) as f:
+            grants = json.load(f)
+    except (OSError, ValueError) as e:
+        print("Could not read {}: {}".format(path, e))
+        exit(1)
+    if not isinstance(grants, dict) or not all(isinstance(p, str) for p in grants.values()):
+        print("{} must map names to permissions".format(path))
+        exit(1)
+    return list(grants.items())
+
+
+def main():
+    """
+    Parse the command line arguments and bootstrap the requested repository.
+    """
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description="GitHub Repo Creation Utility",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-n", "--name", help="Repository Name")
+    parser.add_argument("-o", "--organization", help="Organization Name")
+    parser.add_argument("-d", "--description",
+                        help="Repository Description", default="")
+    parser.add_argument("-b", "--defbranch", help="Default Branch", default="main")
+    parser.add_argument("-c", "--collaborators",
+                        help="JSON file mapping collaborator usernames to permissions")
+    parser.add_argument("-t", "--teams",
+                        help="JSON file mapping team names to permissions")
+    args = parser.parse_args()
+    config = vars(args)
+    print(f"Arguments Passed in: {config}")
+    # Fail on a bad grants file before anything is created rather than half way through
+    collaborators = load_grants(args.collaborators)
+    teams = load_grants(args.teams)
+
+    if "GITHUB_TOKEN" not in os.environ and "GITHUB_TOKENS" not in os.environ:
         print("GITHUB TOKEN not in environment")
         exit(1)
     elif args.name is None:
@@ -251,14 +457,27 @@ if __name__ == '__main__':
     else:
         print("Creating Repo")
         repo = Repo(args.organization, args.name)
-        repo.create_repo("This is a description of the repo")
+        if repo._exists():
+            print("Repo already exists, skipping creation")
+        else:
+            repo.create_repo("This is a description of the repo")
         if args.defbranch != "main":
             print("Updating Default Branch")
             repo.rename_branch("main", args.defbranch)
+
+        # The grants and the .gitignore commit do not depend on each other, so overlap their round trips
         print("Updating Collaborators")
-        # repo.add_repo_collaborator("admin-user", "admin")
-        # repo.add_repo_team("maintain-user", "maintain")
-        # repo.add_repo_team("admin-user", "admin")
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [executor.submit(repo.add_gitignore_to_repo)]
+            if collaborators:
+                futures.append(executor.submit(repo.add_repo_collaborators, collaborators))
+            if teams:
+                futures.append(executor.submit(repo.add_repo_teams, teams))
+            for future in futures:
+                future.result()
+
+        # Protection goes last: it only accepts teams and users that already have write access, and once it
+        # enforces PR reviews the .gitignore could no longer be committed directly
         print("Updating Default Branch Protection")
         repo.protect_branch(
             args.defbranch,
@@ -266,4 +485,8 @@ if __name__ == '__main__':
             pr_bypass_teams=["admin-user"],
             restriction_bypass_teams=["admin-user"]
         )
-        repo.add_gitignore_to_repo()
+        repo.close()
+
+
+if __name__ == '__main__':
+    main()